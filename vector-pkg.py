@@ -19,14 +19,39 @@ import time
 import hashlib
 import sys
 import shutil
+import tarfile
+import fcntl
+import errno
+import gzip
+import json
+import zlib
+import struct
+import fnmatch
+import threading
+import select
+import ctypes
+import ctypes.util
+from io import BytesIO
 
 '''This file will be looked up under OPKG_DIR/conf'''
 OPKG_CONF_FILE='/etc/vpkg/conf/vpkg.env'
 
 META_FILE_PREVIOUS='Previous.meta'
 META_FILE_LATEST='Latest.meta'
+'''Hashes of the installed files, and the last verification of them'''
+META_FILE_SUMS='Files.sha1'
+META_FILE_VERIFY_CACHE='Verify.cache'
+'''Lock for metadata shared by all packages; can't clash with a package name'''
+GLOBAL_LOCK='.global'
 EXTRA_PARAM_DELIM=','
 EXTRA_PARAM_KEY_VAL_SEP='='
+SIZE_UNITS={'':1, 'K':1024, 'M':1024*1024, 'G':1024*1024*1024}
+'''Seekable packages are compressed in blocks of about this many bytes'''
+SEEKABLE_BLOCK_SIZE=64*1024
+'''The seekable package's table of contents, stored as the last file in it'''
+SEEKABLE_TOC_MEMBER='.install/.toc'
+'''What reading a missing, damaged or non-package file can raise'''
+ARCHIVE_ERRORS=(EnvironmentError, zlib.error, tarfile.TarError, ValueError, KeyError, IndexError)
 
 '''Logs an error'''
 def loge(msg):
@@ -37,7 +62,11 @@ def loge(msg):
 '''A helper to create all of the directories along a path'''
 def makedirs(path):
     if not os.path.exists(path):
-        os.makedirs(path)
+        try:
+            os.makedirs(path)
+        except OSError:
+            # Another process may have created it in the meantime
+            if not os.path.isdir(path): raise
 
 '''A helper to remove a directory tree that is no longer needed'''
 def rmtree(path):
@@ -79,28 +108,160 @@ class EnvConfig():
         return self.conf.get(section,item)
 
 
-'''Reads the manifest config parsed from INI file'''
-def get_manifest(manifest_file):
-    "Returns config parsed from INI file in filelike object"
-    config = None
-    try:
-        config = PkgConfigParser();
-        config.read(manifest_file);
+'''The package manifest, parsed and checked once.  Template variables in it
+are resolved in memory as it is loaded, rather than by rewriting the file.'''
+class Manifest():
+    def __init__(self,config,path):
+        self.config=config
+        self.path=path
+        self.errors=[]
+        if not config.has_option("META", 'rel_num'):
+            self.errors.append("rel_num not found")
+            return
+        self.rel_num=config.get("META", 'rel_num')
+        self.meta=self.items('META')
+        self.files=self.items('files') #[(target, source)]
+        self.templates=[tmpl for index,tmpl in self.items('templates')]
+        self.symlinks=self.items('symlinks') #[(link, source)]
+
+        '''Each entry for replacement in the replaces_file is a pair delimited with :'''
+        self.replaces=[] #[(path, pattern, replace)]
+        for replaces_file,token in self.items('replaces'):
+            pair=re.split(Tmpl.TMPL_KEY_VAL_DELIM,token)
+            if len(pair) != 2:
+                self.errors.append("replaces entry for "+replaces_file+" isn't PATTERN"+Tmpl.TMPL_KEY_VAL_DELIM+"REPLACEMENT")
+                continue
+            self.replaces.append((replaces_file,pair[0],pair[1]))
+
+        '''The permissions are in the format, dir=owner:group mod; eg: 'apps=root:root 0444' '''
+        self.permissions=[] #[(path, chown, chmod)]
+        for fpath,perm_opt in self.items('permissions'):
+            opts=perm_opt.split(' ')
+            if len(opts) != 2:
+                self.errors.append("permissions for "+fpath+" aren't OWNER:GROUP MODE")
+                continue
+            self.permissions.append((fpath,opts[0],opts[1]))
+
+    def items(self,section):
+        if not self.config.has_section(section): return []
+        return [(key,self.config.get(section,key)) for key in self.config.options(section)]
+
+    '''Reads the manifest, resolving the {{ var }}s in it with vars_dict.
+       Returns None if it can't be read or has problems.'''
+    @staticmethod
+    def load(manifest_file,vars_dict=None):
+        try:
+            text=loadFile(manifest_file)
+            if vars_dict: text=resolveVarsText(text,vars_dict)
+            config=PkgConfigParser()
+            config.readfp(BytesIO(text),manifest_file)
+        except (EnvironmentError, ConfigParser.Error) as exc:
+            loge ("Error: Problem loading manifest file "+manifest_file)
+            print(exc)
+            return None
+
+        manifest=Manifest(config,manifest_file)
+        for error in manifest.errors:
+            loge ("Error: "+error+" in "+manifest_file)
+        if manifest.errors:
+            return None
+        return manifest
+
+    '''Compiles the steps to install the package extracted in stage_dir.
+    Relative paths are resolved against stage_dir.  Templates and replaces
+    are only applied to the paths is_selected accepts (see --only).'''
+    def compile(self,stage_dir,is_selected):
+        plan=InstallPlan()
 
-    except Exception as exc:
-        loge ("Error: Problem loading manifest file "+manifest_file)
-        print(exc)
-        return
+        '''copy targets entries to install_root'''
+        for base_path in InstallPlan.BASE_PATHS:
+            source_path = os.path.join(stage_dir, base_path)
+            # Did the archive include this top-level folder?
+            if not os.path.exists(source_path): continue
+            plan.add('copy', source_path, '/' + base_path)
 
-    if not config.has_option("META", 'rel_num'):
-        loge ("Error: rel_num not found in "+manifest_file)
-        return
-    return config
+        '''Generate installation template files with actual values, variables are marked as {{ var }} '''
+        for tmpl in self.templates:
+            tmpl_path=os.path.join(stage_dir,tmpl)
+            if not is_selected(tmpl_path): continue
+            plan.add('template', tmpl_path)
+
+        '''Replaces tokens in files flagged for that, tokens are unmarked like PORT=80 etc'''
+        for replaces_file,pattern,replace in self.replaces:
+            replaces_path=os.path.join(stage_dir,replaces_file)
+            if not is_selected(replaces_path): continue
+            plan.add('replace', replaces_path, (pattern,replace))
+
+        for tgt_path,src_path in self.symlinks:
+            plan.add('symlink', os.path.join(stage_dir,tgt_path), src_path)
+
+        for fpath,chown_opt,chmod_opt in self.permissions:
+            plan.add('permissions', os.path.join(stage_dir,fpath), (chown_opt,chmod_opt))
+
+        '''The files that will be changed, to snapshot for undoing the install'''
+        for tgt,src in self.files:
+            plan.undo_paths.append('/' + tgt.strip('/'))
+        for tmpl in self.templates:
+            target = '/' + tmpl.strip('/')
+            if os.path.isabs(tmpl) and target not in plan.undo_paths:
+                plan.undo_paths.append(target)
+
+        return plan
+
+    '''Writes the manifest for a package snapshotting the files the plan will
+    change, to later undo the installation.  Returns the undo manifest.'''
+    def writeUndo(self,plan,undo_manifest_path):
+        undoConfig = PkgConfigParser()
+        # copy the manifest information
+        undoConfig.add_section('META')
+        for key,val in self.meta:
+            undoConfig.set('META', key, val)
+
+        # copy the list of files -- just the ones that will be modified
+        # not the ones from the pkg
+        undoConfig.add_section('files')
+        for target in plan.undo_paths:
+            undoConfig.set('files',target,target)
+
+        # copy and reverse the string flipper
+        # todo: this maybe should be save that file?
+        # - the pattern could be a regular expression so that won'y work easily
+        undoConfig.add_section('replaces')
+        for replaces_file,pattern,replace in self.replaces:
+            undoConfig.set('replaces', replaces_file, replace+Tmpl.TMPL_KEY_VAL_DELIM+pattern)
+
+        # TODO: could fix up the symlinks, permissions but that isn't clear enough how to
+        # write it out
+        with open(undo_manifest_path, 'w+') as cfgfile:
+            undoConfig.write(cfgfile)
+        return Manifest(undoConfig,undo_manifest_path)
+
+'''The steps to install a package, in the order they are done.  Each step is an
+(operation, path, argument) tuple, with the paths already resolved.'''
+class InstallPlan():
+    '''Only well-defined folders are installed, to prevent too much damage'''
+    BASE_PATHS=['anki','etc','home', 'usr', 'var']
+
+    def __init__(self):
+        self.steps=[]
+        self.undo_paths=[] #the files to snapshot, to undo the install
+
+    def add(self,operation,path,arg=None):
+        self.steps.append((operation,path,arg))
+
+    '''Returns True if path on the target is in one of the folders installed'''
+    @staticmethod
+    def covers(path):
+        return path.strip('/').split('/')[0] in InstallPlan.BASE_PATHS
+
+    '''Returns the files that templates and replaces will alter'''
+    def alteredPaths(self):
+        return [path for operation,path,arg in self.steps if operation in ['template','replace']]
 
 
 '''Class for core Open Pkg'''
 class Pkg():
-    def __init__(self,name):
+    def __init__(self,name,build_root=None):
         if re.search("[^\w\-]", name) is not None:
             loge ("Error: Illegal character in package name (" + name + ")")
             return
@@ -111,7 +272,11 @@ class Pkg():
         self.tarball_name = name + '.vpkg'
         self.md5=None #md5 of package being installed.
         self.manifest=None
-        self.build_root = os.getcwd()
+        self.seekable=False #create a seekable package
+        '''build_root - where the manifest and sources are found, and the
+        package is written.  Defaults to the current directory.'''
+        if not build_root: build_root=os.getcwd()
+        self.build_root = os.path.abspath(build_root)
         self.manifest_path=self.build_root+'/'+self.manifest_file
 
         '''stage_dir - where files to create a tarball are staged and
@@ -172,6 +337,8 @@ class Pkg():
         self.rel_num=rel_num
     def setRelTs(self,rel_ts):
         self.rel_ts=rel_ts
+    def setSeekable(self,seekable):
+        self.seekable=seekable
 
     '''Meta file has this syntax: pkg_name,rel_num,rel_ts,pkg_md5,deploy_ts'''
     def loadMeta(self):
@@ -234,26 +401,162 @@ class Pkg():
         rel_ts=0
         if self.rel_ts: rel_ts=self.rel_ts
         strx = self.name+','+rel_num+','+str(rel_ts)+','+self.pkg_md5+','+deploy_inst.deploy_ts+','+os.path.basename(uninstall)
-        cmd = "echo " + strx + ">" + meta_file_latest
-        if not execOSCommand(cmd):
-            loge ("Error: Couldn't record the package installation.")
+        # Written to the side and renamed, so readers never see a partial file
+        try:
+            with open(meta_file_latest+'.tmp', "w") as f:
+                f.write(strx+"\n")
+            os.rename(meta_file_latest+'.tmp', meta_file_latest)
+        except EnvironmentError as err:
+            loge ("Error: Couldn't record the package installation. "+str(err))
             return False
         self.loadMeta()
 
         return True
 
+    '''Keeps the hashes of the installed files in the meta folder, for verify.
+    The files altered by templates and replaces are hashed as installed.'''
+    def registerFileSums(self,stage_dir,deploy_inst,altered_paths):
+        meta_dir=os.path.join(deploy_inst.opkg_dir,'meta',self.name)
+        sums_path=os.path.join(meta_dir,META_FILE_SUMS)
+        pkg_sums=readFileSums(os.path.join(stage_dir,'.install',self.name+'.sha1'))
+        if pkg_sums is None:
+            print ("Info: Package "+self.name+" has no file hashes, it can't be verified.")
+            if os.path.exists(sums_path): os.remove(sums_path)
+            return
+        sums=dict()
+        if deploy_inst.only:
+            sums=readFileSums(sums_path) or dict()
+        for path in pkg_sums:
+            # files outside the installed folders are packaged, but not installed
+            if not InstallPlan.covers(path): continue
+            if deploy_inst.isSelected(path): sums[path]=pkg_sums[path]
+        for path in sums:
+            for altered in altered_paths:
+                if (path == altered or path.startswith(altered.rstrip('/')+'/')) and os.path.isfile(path):
+                    sums[path]=getFileSHA1(path)
+        try:
+            with open(sums_path+'.tmp','w') as f:
+                for path in sorted(sums):
+                    f.write(sums[path]+'  '+path+'\n')
+            os.rename(sums_path+'.tmp',sums_path)
+            if os.path.exists(os.path.join(meta_dir,META_FILE_VERIFY_CACHE)):
+                os.remove(os.path.join(meta_dir,META_FILE_VERIFY_CACHE))
+        except EnvironmentError as err:
+            loge ("Warning: Couldn't record the hashes of the installed files. "+str(err))
+
+    '''Checks the installed files against the hashes recorded when the package
+    was installed.  A file whose size and mtime haven't changed since it was
+    last verified isn't read again; the rest are hashed by up to workers
+    threads.  The caller holds the package's lock.  Returns a report.'''
+    def verify(self,opkg_dir,workers):
+        meta_dir=os.path.join(opkg_dir,'meta',self.name)
+        report={'pkg':self.name,'status':'ok','checked':0,'cached':0,'modified':[],'missing':[],'unreadable':[]}
+        if not self.loadMetaFile(os.path.join(meta_dir,META_FILE_LATEST)):
+            report['status']='not-installed'
+            return report
+        sums=readFileSums(os.path.join(meta_dir,META_FILE_SUMS))
+        if sums is None:
+            report['status']='unverifiable'
+            return report
+
+        cache_path=os.path.join(meta_dir,META_FILE_VERIFY_CACHE)
+        cache=dict()
+        if os.path.isfile(cache_path):
+            try:
+                cache=json.loads(loadFile(cache_path))
+            except ValueError:
+                pass
+
+        new_cache=dict()
+        actual=dict()
+        todo=[]
+        for path in sorted(sums):
+            try:
+                st=os.stat(path)
+            except OSError:
+                report['missing'].append(path)
+                continue
+            old=cache.get(path)
+            if old and old[:2] == [st.st_size,st.st_mtime]:
+                actual[path]=old[2]
+                new_cache[path]=old
+                report['cached']+=1
+            else:
+                todo.append((path,st))
+
+        def hashFile(item):
+            try:
+                return getFileSHA1(item[0])
+            except (IOError, OSError):
+                return None #eg, replaced by a folder
+        digests=runParallel(hashFile,todo,workers)
+        for (path,st),digest in zip(todo,digests):
+            if digest is None:
+                report['unreadable'].append(path)
+                continue
+            actual[path]=digest
+            new_cache[path]=[st.st_size,st.st_mtime,digest]
+        report['checked']=len(todo)
+
+        report['modified']=[path for path in sorted(actual) if actual[path] != sums[path]]
+        if report['modified'] or report['missing'] or report['unreadable']:
+            report['status']='modified'
+
+        try:
+            with open(cache_path+'.tmp','w') as f:
+                json.dump(new_cache,f)
+            os.rename(cache_path+'.tmp',cache_path)
+        except EnvironmentError as err:
+            loge ("Warning: Couldn't save "+cache_path+". "+str(err))
+        return report
+
     def setEnvConfig(self,env_conf):
         self.env_conf=env_conf
 
-    def create(self):
+    '''Creates the package.  The staging area is removed whether or not
+       this succeeds, so that failed builds don't leave .pkg/ debris behind.
+       With use_cache, the package is only rebuilt if the manifest or one of
+       its sources has changed since it was last built.'''
+    def create(self,use_cache=True):
+        with PkgLock(os.path.join(self.build_root,'.pkg'),self.name):
+            return self.createLocked(use_cache)
+
+    '''Creates the package; the caller holds its lock in BUILD_ROOT/.pkg/lock,
+       so other runs creating it from the same build root wait their turn.'''
+    def createLocked(self,use_cache):
         #the default manifest points to that in build dir
-        self.manifest = get_manifest(self.manifest_path)
+        if not self.manifest:
+            self.manifest = Manifest.load(self.manifest_path)
+        if not self.manifest:
+            return False
+        self.tarball_name = self.name + '-' + self.manifest.rel_num + '.vpkg'
+        tarball_path = os.path.join(self.build_root, self.tarball_name)
 
+        cache=None
+        if use_cache:
+            cache=BuildCache(self)
+            if cache.fetch(tarball_path):
+                print ("Package " + self.tarball_name + " is up to date.")
+                return True
 
-        rmtree(self.stage_dir) 
+        rmtree(self.stage_dir)
         makedirs(self.stage_dir)
-        os.chdir(self.stage_dir)
+        try:
+            if not self.createStaged():
+                return False
+            staged_tarball = os.path.join(self.stage_dir, self.tarball_name)
+            if cache: cache.store(staged_tarball)
+            shutil.move(staged_tarball, tarball_path)
+            print ("Package " + self.tarball_name + " has been created.")
+        except  Exception as err:
+            loge ("Error: Package " + self.tarball_name + " couldn't be created. "+str(err))
+            return False
+        finally:
+            rmtree(self.stage_dir)
 
+        return True
+
+    def createStaged(self):
         '''Copy manifest to the deploy folder in archive'''
         makedirs(self.deploy_dir)
         try:
@@ -263,78 +566,36 @@ class Pkg():
             return False
 
         '''Stage files content for archiving'''
-        if self.manifest.has_section('files'):
-            for tgt in self.manifest.options('files'):
-                src = self.manifest.get('files',tgt)
-                if not self.stageContent(os.path.join(self.build_root,src),tgt.strip('/')):
-                    loge ("Error: Cannot copy content at "+src+" for archiving.")
-                    return False
+        for tgt,src in self.manifest.files:
+            if not self.stageContent(os.path.join(self.build_root,src),tgt.strip('/')):
+                loge ("Error: Cannot copy content at "+src+" for archiving.")
+                return False
 
-        '''Make tarball and clean up the staging area'''
-        if self.manifest.has_option("META", 'rel_num'):
-            rel_num=self.manifest.get("META", 'rel_num')
-            self.tarball_name = self.name + '-' + rel_num + '.vpkg'
-        os.chdir(self.stage_dir)
-        rc = runCmd("tar czf " + self.tarball_name + ' * '+os.path.basename(self.deploy_dir))
-        if rc != 0:
-            loge ("Error: Couldn't create package " + self.tarball_name)
-            return False
-        os.chdir(self.build_root)
+        '''Record the hash of each file, so the installed files can be verified'''
         try:
-            shutil.move(self.stage_dir + '/' + self.tarball_name, './')
-            rmtree(self.stage_dir) 
-            print ("Package " + self.tarball_name + " has been created.")
-        except  Exception as err:
-            loge ("Error: Package " + self.tarball_name + " couldn't be created. "+str(err))
+            writeFileSums(os.path.join(self.deploy_dir, self.name + '.sha1'), self.stage_dir)
+        except EnvironmentError as err:
+            loge ("Error: Couldn't record the hashes of the files. " + str(err))
             return False
 
-    '''Creates an archive snapshotting the current state.  This is used to to
-       later undoan installation.'''
-    def createUndoManifest(self,undoManifestPath):
-        undoConfig = PkgConfigParser()
-        #copy the key pieces from the manifest
-        self.manifest = get_manifest(self.manifest_path)
-        # copy the manifest information
-        if self.manifest.has_section('META'):
-            undoConfig.add_section('META')
-            for tgt in self.manifest.options('META'):
-                undoConfig.set('META', tgt, self.manifest.get('META', tgt))
-
-        # copy the list of files -- just the ones that will be modified
-        # not the ones from the pkg
-        undoConfig.add_section('files')
-        if self.manifest.has_section('files'):
-            for tgt in self.manifest.options('files'):
-                target = '/' + tgt.strip('/')
-                undoConfig.set('files',target,target)
+        '''Make tarball in the staging area'''
+        entries = os.listdir(self.stage_dir)
+        staged_tarball = os.path.join(self.stage_dir, self.tarball_name)
+        try:
+            makeTarball(staged_tarball, self.stage_dir, entries, self.seekable)
+        except (IOError, OSError, tarfile.TarError) as err:
+            loge ("Error: Couldn't create package " + self.tarball_name + ". " + str(err))
+            return False
 
-        if self.manifest.has_section('templates'):
-            for index in self.manifest.options('templates'):
-                target = '/' + self.manifest.get('templates',index)+ tgt.strip('/')
-                undoConfig.set('files',target,target)
-                
+        return True
 
-        # copy and reverse the string flipper
-        # todo: this maybe should be save that file?
-        # - the pattern could be a regular expression so that won'y work easily
-        if self.manifest.has_section('replaces'):
-            undoConfig.add_section('replaces')
-            for replaces_file,token in self.manifest.items('replaces'):
-                '''Each entry for replacement in the replaces_file is a dict as replacement entries are delimited with :
-                  We'll reverse those'''
-                pattern, replace = re.split(Tmpl.TMPL_KEY_VAL_DELIM,token)
-                undoConfig.set('replaces', replaces_file, replace+Tmpl.TMPL_KEY_VAL_DELIM+pattern)
+    def setManifest(self,manifest):
+        self.manifest=manifest
 
-        # TODO: could fix up the symlinks, permissions but that isn't clear enough how to
-        # write it out
-        cfgfile = open(undoManifestPath, 'w+')
-        undoConfig.write(cfgfile)
-        cfgfile.close()
-    
     # How to launch a making of the archive?
 
     def stageContent(self,src,tgt):
-        os.chdir(self.stage_dir)
+        tgt = os.path.join(self.stage_dir, tgt)
         if os.path.isdir(src):
             '''skip build folder silently, but individual files can still be added.'''
             try:
@@ -344,7 +605,7 @@ class Pkg():
                 return False
         else:
             tgt_dir = os.path.dirname(tgt)
-            if tgt_dir != '':
+            if tgt_dir != self.stage_dir:
                 try:
                     makedirs(tgt_dir)
                 except:
@@ -357,123 +618,120 @@ class Pkg():
 
         return True
 
-    '''Execute the deploy playbook for a package specified in the manifest'''
+    '''Execute the deploy playbook for a package specified in the manifest.
+    pkg_name is the package the install is for; everything staged for it is
+    kept under stage_dir/pkg_name, which the caller must hold the lock for.'''
     def install(self,tarball_path,deploy_inst,pkg_name):
-        deploy_inst.logHistory("Installing package "+self.name+" using "+tarball_path)
+        deploy_inst.logHistory("Installing package "+self.name+" using "+tarball_path,pkg_name)
 
-        ''' Track the md5 of package being installed '''
+        ''' Track the md5 of package being installed.  A partial install isn't
+        recorded as the package, so a later full install won't be skipped.'''
         self.pkg_md5=getFileMD5(tarball_path)
+        if deploy_inst.only: self.pkg_md5='partial'
 
         '''Extract the tarball in stage_dir, to prepare for deploy playbook to  execute steps'''
-        stage_dir=os.path.join(deploy_inst.stage_dir,self.name,deploy_inst.deploy_ts)
+        pkg_stage_dir=os.path.join(deploy_inst.stage_dir,pkg_name)
+        stage_dir=os.path.join(pkg_stage_dir,deploy_inst.deploy_ts)
         try:
             makedirs(stage_dir)
         except:
             return
-        os.chdir(stage_dir)
-
-        if not execOSCommand('tar xzf ' + tarball_path):
+        try:
+            return self.installStaged(tarball_path,deploy_inst,pkg_name,stage_dir)
+        finally:
+            '''delete the stage_dir whether or not the package was installed'''
+            print ("deleting " + stage_dir)
+            rmtree(pkg_stage_dir)
+
+    def installStaged(self,tarball_path,deploy_inst,pkg_name,stage_dir):
+        if not self.extract(tarball_path,stage_dir,deploy_inst):
             loge ("Error: Problem extracting " + tarball_path + " in " + stage_dir)
             return False
 
 
-        '''Resolve manifest, and files defined under templates and replaces with actual values 
-        defined for this specific installation.'''
-        self.manifest_path=os.path.join(os.getcwd(),os.path.join(".install",self.manifest_file))
-        tmpl_inst=Tmpl(self.manifest_path)
-        if not tmpl_inst.resolveVars(deploy_inst.getVars()):
+        '''Resolve manifest with actual values defined for this specific
+        installation, and work out the steps to install it.'''
+        self.manifest_path=os.path.join(stage_dir,".install",self.manifest_file)
+        self.manifest=Manifest.load(self.manifest_path,deploy_inst.getVars())
+        if not self.manifest:
             loge ("Error: Problem resolving "+self.manifest_file)
             return False
-        pkg_manifest=get_manifest(self.manifest_path)
-        
+        plan=self.manifest.compile(stage_dir,deploy_inst.isSelected)
+
         '''Snapshot the files that will be changed to allow undoing'''
         if not deploy_inst.uninstall:
-            deploy_inst.logHistory("Making backup")
-            undo_manifest_path=os.path.join(deploy_inst.stage_dir, pkg_name+"_undo.ini")
-            self.createUndoManifest(undo_manifest_path)
-            os.chdir(deploy_inst.stage_dir)
-            undo_pkg=Pkg(pkg_name+"_undo")
-            undo_pkg.create()
-            runCmd("rm " + undo_manifest_path)
-            os.chdir(stage_dir)
+            deploy_inst.logHistory("Making backup",pkg_name)
+            undo_build_root=os.path.dirname(stage_dir)
+            undo_pkg=Pkg(pkg_name+"_undo",undo_build_root)
+            undo_pkg.setManifest(self.manifest.writeUndo(plan,undo_pkg.manifest_path))
+            undo_pkg.create(False)
+            runCmd("rm " + undo_pkg.manifest_path)
+
+        if not self.runPlan(plan,deploy_inst):
+            return False
 
-        '''copy targets entries to install_root'''
-        # Only uses well-defined folders to prevent too much damage
-        for base_path in ['anki','etc','home', 'usr', 'var']:
-            source_path = os.path.join(stage_dir, base_path)
-            # Did the archive include this top-level folder?
-            if not os.path.exists(source_path): continue
+        ''' Register the installation and the uninstall package'''
+        if not deploy_inst.uninstall:
+            self.registerInstall(deploy_inst, os.path.join(undo_build_root, undo_pkg.tarball_name))
+            self.registerFileSums(stage_dir, deploy_inst, plan.alteredPaths())
 
-            # Command to copy the folder onto the main system
-            target_path = '/' + base_path
-            cmd='cp -r '+source_path+'/* '+target_path+'/'
-            if not execOSCommand(cmd):
-                loge ("Error: Problem copying from " + stage_dir + ". command: " + cmd)
-                return False
+        if not deploy_inst.uninstall:
+            deploy_inst.logHistory("Installed",pkg_name)
+            print ("Info: Package "+self.name+" has been installed")
+        else:
+            deploy_inst.logHistory("Uninstalled",pkg_name)
+            print ("Info: Package has been uninstalled.")
 
-        '''Generate installation template files with actual values, variables are marked as {{ var }} '''
-        if pkg_manifest.has_section('templates'):
-            for index in pkg_manifest.options('templates'):
-                tmpl = pkg_manifest.get('templates',index)
-                tmpl_path=tmpl
-                #if not re.match("^\/", tmpl): tmpl_path = deploy_dir + "/" + tmpl
-                tmpl_inst=Tmpl(tmpl_path)
+        return True
+
+    '''Carries out the steps of the install plan'''
+    def runPlan(self,plan,deploy_inst):
+        for operation,path,arg in plan.steps:
+            if operation == 'copy':
+                # Command to copy the folder onto the main system
+                cmd='cp -r '+path+'/* '+arg+'/'
+                if not execOSCommand(cmd):
+                    loge ("Error: Problem copying from " + path + ". command: " + cmd)
+                    return False
+
+            elif operation == 'template':
+                tmpl_inst=Tmpl(path)
                 if not tmpl_inst.resolveVars(deploy_inst.getVars()):
                     loge ("Error: Couldn't install resolved files for those marked as templates, with real values.")
                     return False
 
-        '''Replaces tokens in files flagged for that, tokens are unmarked like PORT=80 etc'''
-        if pkg_manifest.has_section('replaces'):
-            for replaces_file,pattern in pkg_manifest.items('replaces'):
-                '''Each entry for replacement in the replaces_file is a dict as replacement entries are delimited with :'''
-                replaces_path=replaces_file
-                #if not re.match("^\/", replaces_file): replaces_path = deploy_dir + "/" + replaces_file
-                tmpl_inst=Tmpl(replaces_path)
-                if not tmpl_inst.replaceTokens(pattern):
+            elif operation == 'replace':
+                tmpl_inst=Tmpl(path)
+                if not tmpl_inst.replaceTokens(arg[0],arg[1]):
                     loge ("Error: Couldn't install resolved files for those marked with having tokens in the 'replaces' section, with real values.")
                     return False
 
-        '''Symlinks'''
-        if pkg_manifest.has_section('symlinks'):
-            for tgt_path in pkg_manifest.options('symlinks'):
-                src_path = pkg_manifest.get('symlinks',tgt_path)
-                #if not re.match("^\/", tgt_path): tgt_path = deploy_dir + "/" + tgt_path
-                #if not re.match("^\/", src_path): src_path = deploy_dir + "/" + src_path
-                cmd = "ln -sfn " + src_path + " " + tgt_path
+            elif operation == 'symlink':
+                cmd = "ln -sfn " + arg + " " + path
                 if not execOSCommand(cmd):
                     loge ("Error: Problem creating symlink " + cmd)
                     return False
 
-        '''Permissions
-        The list items will be returned in the format, dir=owner:group mod; eg: 'apps=root:root 0444'
-        Parse each line accordingly.
-        '''
-        if pkg_manifest.has_section('permissions'):
-            for fpath in pkg_manifest.options('permissions'):
-                perm_opt= pkg_manifest.get('permissions',fpath)
-                chown_opt,chmod_opt = perm_opt.split(' ')
-                #if not re.match("^\/", fpath): fpath = deploy_dir + "/" + fpath
-                cmd="chown -R "+chown_opt+" "+fpath+';chmod -R '+chmod_opt+' '+fpath
+            elif operation == 'permissions':
+                chown_opt,chmod_opt=arg
+                cmd="chown -R "+chown_opt+" "+path+';chmod -R '+chmod_opt+' '+path
                 if not execOSCommand(cmd):
-                    loge ("Error: Problem setting permissions on " + fpath+'. Command: '+cmd)
+                    loge ("Error: Problem setting permissions on " + path+'. Command: '+cmd)
                     return False
 
-       
-        ''' Register the installation and the uninstall package'''
-        if not deploy_inst.uninstall:
-            self.registerInstall(deploy_inst, os.path.join(deploy_inst.stage_dir, undo_pkg.tarball_name))
-
-        '''delete the stage_dir upon successful installation of the package'''
-        os.chdir("/tmp")  # a workaround to avoid system warning when curr dir stage_dir is deleted.
-        print ("deleting " + stage_dir)
-        if not execOSCommand('rm -r ' + stage_dir):
-            print ("Warning: Couldn't delete " + stage_dir)
-
-        if not deploy_inst.uninstall:
-            print ("Info: Package "+self.name+" has been installed")
-        else:
-            print ("Info: Package has been uninstalled.")
+        return True
 
+    '''Extracts the package into stage_dir.  Seekable packages are decompressed
+    in parallel, and only the blocks holding the files selected with --only.'''
+    def extract(self,tarball_path,stage_dir,deploy_inst):
+        try:
+            archive=VpkgArchive(tarball_path)
+            if not archive.toc and not deploy_inst.only:
+                return execOSCommand('tar xzf ' + tarball_path + ' -C ' + stage_dir)
+            archive.extract(stage_dir,deploy_inst.isSelectedMember,deploy_inst.workers)
+        except ARCHIVE_ERRORS as err:
+            loge ("Error: "+tarball_path+" is not a package. "+str(err))
+            return False
         return True
 
     def isInstalled(self,tarball_path):
@@ -485,12 +743,13 @@ class Pkg():
 
 '''Class to process the main opkg actions'''
 class opkg():
-    ACTIONS=['create','list','install']
+    ACTIONS=['create','list','install','uninstall','gc','info','contents','history','verify','watch']
 
     '''action specific required configs'''
     ACTION_CONFIGS={
         'install': ['install_root'],
         'list':['install_root'],
+        'gc':['stage_dir'],
     }
 
     OPKG_LABEL='vector-pkg'
@@ -547,12 +806,12 @@ class opkg():
         if 'opkg_dir' in self.arg_dict: opkg_conf_file=self.arg_dict['opkg_dir']+'/conf/opkg.env'
         self.conf_file=opkg_conf_file
         self.loadConfigFile()
-        self.opkg_dir=self.configs['basic']['opkg_dir']
 
         '''Override config items specified in config file with those from command-line'''
         for section in self.configs:
             for item in self.configs[section]:
                 if item in self.arg_dict: self.configs[section][item]=self.arg_dict[item]
+        self.opkg_dir=self.configs['basic']['opkg_dir']
 
         '''Parse out common options such as pkg'''
         if 'pkg' in self.arg_dict:
@@ -563,13 +822,20 @@ class opkg():
     '''Loads configs from opkg.env as a dictionary'''
     def loadConfigFile(self):
         self.configs['basic']={'opkg_dir': '/etc/vpkg','stage_dir':'/tmp/vpkg-staging',
-                                        'deploy_history_file':'/var/log/deploy_history.log',
-                                        'install_root': '/tmp/vpkg'};
+                                        'install_root': '/tmp/vpkg', 'workers': '2',
+                                        'deploy_history_file':'/var/log/deploy_history.log'};
+        '''Disk-space budgets; sizes may have a K, M or G suffix'''
+        self.configs['gc']={'auto_gc':'yes','undo_quota':'8M',
+                                        'history_quota':'256K','history_segment_size':'32K',
+                                        'min_free_space':'16M'};
+        '''How often watch polls when inotify isn't available, how long a burst
+        of changes must settle for, and the longest it is waited for; in seconds'''
+        self.configs['watch']={'poll_interval':'1','debounce':'0.2','max_delay':'2'};
         Config = PkgConfigParser()
         Config.read(self.conf_file)
         sections=Config.sections()
         for section in sections:
-            self.configs[section]=dict()
+            if section not in self.configs: self.configs[section]=dict()
             for item in Config.options(section):
                 self.configs[section][item]=Config.get(section,item)
         return
@@ -587,9 +853,15 @@ class opkg():
         print (script + " --version")
         print (script + " --help")
         print (script + " list [--pkg=pkg1,pkg2,...]")
-        print (script + " create --pkg=pkg1,pkg2,... [--release]")
-        print (script + " install --pkg=pkg1,pkg2[-REL_NUM|dev],... [--install_root=/path/to/install]")
+        print (script + " create --pkg=pkg1,pkg2,... [--release] [--rebuild] [--seekable]")
+        print (script + " install --pkg=pkg1,pkg2[-REL_NUM|dev],... [--install_root=/path/to/install] [--only=GLOB]")
+        print (script + " info --pkg=/path/to/pkg1.vpkg,...")
+        print (script + " contents --pkg=/path/to/pkg1.vpkg,...")
         print (script + " uninstall [--pkg=pkg1,pkg2,...]")
+        print (script + " gc [--undo_quota=SIZE] [--history_quota=SIZE]")
+        print (script + " history [--pkg=pkg1,pkg2,...] [--since=TIME]")
+        print (script + " verify [--pkg=pkg1,pkg2,...] [--workers=N]")
+        print (script + " watch --pkg=pkg1 --root=/path/to/target [--poll] [--debounce=SECONDS]")
 
         return True
 
@@ -600,7 +872,8 @@ class opkg():
             self.extra_vars['OPKG_ACTION'] = 'create'
             for pkg in self.pkgs:
                 pkg_inst=Pkg(pkg)
-                pkg_inst.create()
+                pkg_inst.setSeekable('seekable' in self.arg_dict)
+                pkg_inst.create('rebuild' not in self.arg_dict)
 
         elif self.action=='list':
             self.extra_vars['OPKG_ACTION'] = 'list'
@@ -631,7 +904,7 @@ class opkg():
                 print("installing "+pkg_name)
 
                 '''Start installation of the package once the tarball is copied to staging location.'''
-                deploy_inst.installPackage(pkg_name,tarball_name,pkg_name_rel_num,os.path.join(os.getcwd(),pkg))
+                deploy_inst.installPackage(pkg_name,tarball_name,pkg_name_rel_num,os.path.abspath(pkg))
         elif self.action=='uninstall':
             self.extra_vars['OPKG_ACTION'] = 'uninstall'
             self.arg_dict['uninstall']=''
@@ -640,22 +913,82 @@ class opkg():
                 self.pkgs = []
 
             for pkg in self.pkgs:
-                # First, look up the package to undo it
                 pkg_name,pkg_name_rel_num,tarball_name =Pkg.parseName(pkg)
-                pkg_inst=Pkg(pkg_name)
-                pkg_inst.setEnvConfig(self.configs)
-                pkg_inst.loadMeta()
-                pkg_meta=pkg_inst.getMeta()
-                if not pkg_meta: continue
-
-                undo_package_name = pkg_meta['latest_install']['undo_package'];
-                pkg_name,pkg_name_rel_num,tarball_name =Pkg.parseName(undo_package_name)
-                
-                '''Start uninstallation of the package.'''
-                deploy_inst.installPackage(pkg_name,os.path.join(pkg_meta['dir'],tarball_name),pkg_name_rel_num,os.path.join(pkg_meta['dir'],undo_package_name))
+                deploy_inst.uninstallPackage(pkg_name)
+        elif self.action=='info':
+            self.extra_vars['OPKG_ACTION'] = 'info'
+            for pkg in self.pkgs or []:
+                try:
+                    archive=VpkgArchive(pkg)
+                    manifests=[name for name,size,is_dir in archive.members()
+                               if fnmatch.fnmatch(name,'.install/*.ini') and name.count('/') == 1]
+                    if len(manifests) != 1:
+                        loge ("Error: No manifest found in "+pkg)
+                        continue
+                    manifest=archive.readMember(manifests[0])
+                except ARCHIVE_ERRORS as err:
+                    loge ("Error: "+pkg+" is not a package. "+str(err))
+                    continue
+                print (manifest.decode('utf-8'))
+
+        elif self.action=='contents':
+            self.extra_vars['OPKG_ACTION'] = 'contents'
+            for pkg in self.pkgs or []:
+                try:
+                    members=VpkgArchive(pkg).members()
+                except ARCHIVE_ERRORS as err:
+                    loge ("Error: "+pkg+" is not a package. "+str(err))
+                    continue
+                for name,size,is_dir in members:
+                    if name == SEEKABLE_TOC_MEMBER: continue
+                    if is_dir: name+='/'
+                    print (str(size)+' '+name)
+
+        elif self.action=='history':
+            self.extra_vars['OPKG_ACTION'] = 'history'
+            since=None
+            if 'since' in self.arg_dict:
+                since=parseTime(self.arg_dict['since'])
+                if since is None:
+                    loge ("Error: Cannot parse time "+self.arg_dict['since'])
+                    Exit(1)
+            history=History(self.configs)
+            for record in history.query(self.pkgs,since):
+                print (json.dumps(record,sort_keys=True))
+
+        elif self.action=='verify':
+            self.extra_vars['OPKG_ACTION'] = 'verify'
+            if None == self.pkgs:
+                path = os.path.join(self.opkg_dir, 'meta')
+                self.pkgs = []
+                if os.path.exists(path):
+                    self.pkgs = sorted(os.listdir(path))
 
-                # finally nuke the old folder
-                rmtree(pkg_meta['dir']) 
+            rc=0
+            for pkg in self.pkgs:
+                pkg_name, pkg_name_rel_num, tarball_name = Pkg.parseName(pkg)
+                with PkgLock(self.opkg_dir,pkg_name):
+                    report=Pkg(pkg_name).verify(self.opkg_dir,int(self.configs['basic']['workers']))
+                print (json.dumps(report,sort_keys=True))
+                if report['status'] != 'ok': rc=1
+            Exit(rc)
+
+        elif self.action=='watch':
+            self.extra_vars['OPKG_ACTION'] = 'watch'
+            if not self.pkgs or len(self.pkgs) != 1:
+                loge ("Error: watch takes one package")
+                Exit(1)
+            if not self.arg_dict.get('root'):
+                loge ("Error: watch needs the --root to push the package to")
+                Exit(1)
+            watcher=Watcher(self.configs,self.pkgs[0],self.arg_dict['root'],self.extra_vars,'poll' in self.arg_dict)
+            if not watcher.run(): Exit(1)
+
+        elif self.action=='gc':
+            self.extra_vars['OPKG_ACTION'] = 'gc'
+            gc_inst=GarbageCollector(self.configs)
+            reclaimed=gc_inst.collect()
+            print ("Info: Reclaimed "+str(reclaimed)+" bytes.")
         else:
             print ("Unsupported action: "+self.action)
 
@@ -669,20 +1002,28 @@ class Deploy():
         self.opkg_dir=self.env_conf['basic']['opkg_dir']
         self.stage_dir=self.env_conf['basic']['stage_dir']
         self.history_dir=os.path.join(self.opkg_dir,'history')
-        self.extra_vars=extra_vars
+        self.history=History(env_conf)
+        '''A copy, as the OPKG_ vars are set per package, and Deploys in other
+        threads may have been given the same dict'''
+        self.extra_vars=dict(extra_vars or {})
+        self.gc=GarbageCollector(env_conf)
+        self.auto_gc=isTrue(self.env_conf['gc']['auto_gc'])
+        self.workers=int(self.env_conf['basic']['workers'])
 
         self.deploy_force=False
         self.uninstall=False
         if 'force' in deploy_options: self.deploy_force=True
+        '''only install the files matching this glob'''
+        self.only=deploy_options.get('only')
+        if self.only: self.deploy_force=True
         if 'uninstall' in deploy_options:
             self.deploy_force=True
             self.uninstall=True
 
-        if not self.extra_vars: self.extra_vars=dict()
         self.extra_vars['OPKG_NAME'] = None
         self.extra_vars['OPKG_REL_NUM'] = None
         self.extra_vars['OPKG_TS'] = None
-        self.extra_vars['OPKG_ACTION'] = None
+        if 'OPKG_ACTION' not in self.extra_vars: self.extra_vars['OPKG_ACTION'] = None
 
         try:
             makedirs(self.history_dir)
@@ -692,19 +1033,137 @@ class Deploy():
             return
         #if not execOSCommand('mkdir -p ' + self.history_dir): return
 
+    '''Returns True if the path on the target was selected with --only.
+    A path is selected if it, or a folder it is in, matches the glob.'''
+    def isSelected(self,path):
+        if not self.only: return True
+        while path not in ['/','']:
+            if fnmatch.fnmatch(path,self.only): return True
+            path=os.path.dirname(path)
+        return False
+
+    '''Returns True if the package member is to be extracted'''
+    def isSelectedMember(self,name):
+        if name.startswith('.install/') or name == '.install': return True
+        return self.isSelected('/'+name)
+
     '''Returns the extra-vars specified from commandline and the OPKG_ vars'''
     def getVars(self):
         return self.extra_vars
 
-    def logHistory(self,log_entry):
-        history_log=self.deploy_ts+": "+log_entry
-        history_file=self.env_conf['basic']['deploy_history_file']
-        with open(os.path.join(self.history_dir, history_file), "a+") as hf: hf.write(history_log+"\n")
+    '''Records an event in the deploy history.  The entries are buffered, and
+       written out once the package is done with.'''
+    def logHistory(self,log_entry,pkg_name=None):
+        if not pkg_name: pkg_name=self.extra_vars['OPKG_NAME']
+        self.history.log({'ts':int(self.deploy_ts), 'time':time.time(), 'pkg':pkg_name,
+                          'action':self.extra_vars['OPKG_ACTION'], 'rel_num':self.extra_vars['OPKG_REL_NUM'],
+                          'msg':log_entry})
 
         return True
 
-    '''The tarball is downloaded/copied to download_dir'''
+    '''Checks that there is room for the install, with the reserve on top: in
+       the staging area for the extracted package and the undo snapshot, and
+       on each filesystem the package's files are copied to.  If not, garbage
+       is collected before giving up.'''
+    def checkFreeSpace(self,tarball_path):
+        needs=self.spaceNeeded(tarball_path)
+        short=[need for need in needs if freeSpace(need[0]) < need[1]]
+        if short and self.auto_gc:
+            print ("Info: Low on disk space, collecting garbage.")
+            self.gc.collect()
+            short=[need for need in needs if freeSpace(need[0]) < need[1]]
+        for path,need in short:
+            loge ("Error: Not enough free space on "+path+" to install "+tarball_path+", "+str(need)+" bytes are needed.")
+        return not short
+
+    '''Returns a [path, bytes needed] for each filesystem the install writes to'''
+    def spaceNeeded(self,tarball_path):
+        try:
+            archive=VpkgArchive(tarball_path)
+        except ARCHIVE_ERRORS:
+            archive=None
+        writes=[(self.stage_dir,0)]
+        if not archive or not archive.toc:
+            '''Listing a plain package means decompressing all of it, so the
+            size of the whole, from the gzip trailer, is allowed for wherever
+            it may go: the stage, the undo snapshot, and each target filesystem'''
+            size=max(getGzipSize(tarball_path),pathSize(tarball_path))
+            writes.append((self.stage_dir,size))
+            if not self.uninstall:
+                writes.append((self.stage_dir,2*size))
+                writes.append((os.path.join(self.opkg_dir,'meta'),size))
+            targets=dict()
+            for base_path in InstallPlan.BASE_PATHS:
+                targets.setdefault(deviceOf('/'+base_path),'/'+base_path)
+            for dev,path in sorted(targets.items()):
+                writes.append((path,size))
+            return self.sumWrites(writes)
+
+        for name,size,is_dir in archive.members():
+            if is_dir or not self.isSelectedMember(name): continue
+            writes.append((self.stage_dir,size))
+            if not InstallPlan.covers(name): continue
+            target='/'+name
+            writes.append(('/'+name.split('/')[0],size))
+            if not self.uninstall and os.path.isfile(target):
+                # the undo snapshot stages a copy of the file replaced, then
+                # archives it, and the archive is kept in OPKG_DIR/meta
+                writes.append((self.stage_dir,2*os.path.getsize(target)))
+                writes.append((os.path.join(self.opkg_dir,'meta'),os.path.getsize(target)))
+        return self.sumWrites(writes)
+
+    '''Totals the (path, bytes) written for each filesystem, with the reserve'''
+    def sumWrites(self,writes):
+        needs=dict() #device -> [path, bytes needed]
+        for path,size in writes:
+            dev=deviceOf(path)
+            if dev not in needs: needs[dev]=[path,self.gc.min_free_space]
+            needs[dev][1]+=size
+        return sorted(needs.values())
+
+    '''The tarball is downloaded/copied to download_dir.
+    Holds the package's lock while installing, so other vector-pkg.py runs
+    or threads (each with their own Deploy) can install other packages.'''
     def installPackage(self,pkg_name,tarball_name,pkg_name_rel_num,tarball_path):
+        try:
+            with PkgLock(self.opkg_dir,pkg_name):
+                rc=self.installPackageLocked(pkg_name,tarball_name,pkg_name_rel_num,tarball_path,pkg_name)
+        finally:
+            self.history.flush()
+        if self.auto_gc:
+            self.gc.collect()
+        return rc
+
+    '''Restores the files that were snapshotted when the package was installed'''
+    def uninstallPackage(self,pkg_name):
+        try:
+            with PkgLock(self.opkg_dir,pkg_name):
+                # First, look up the package to undo it
+                pkg_inst=Pkg(pkg_name)
+                pkg_inst.setEnvConfig(self.env_conf)
+                pkg_inst.loadMeta()
+                pkg_meta=pkg_inst.getMeta()
+                if not pkg_meta['latest_install']: return False
+
+                undo_package_name = pkg_meta['latest_install']['undo_package'];
+                undo_name,undo_name_rel_num,tarball_name =Pkg.parseName(undo_package_name)
+
+                '''Start uninstallation of the package.'''
+                rc=self.installPackageLocked(undo_name,os.path.join(pkg_meta['dir'],tarball_name),undo_name_rel_num,os.path.join(pkg_meta['dir'],undo_package_name),pkg_name)
+
+                # finally nuke the old folder
+                if rc: rmtree(pkg_meta['dir'])
+        finally:
+            self.history.flush()
+        if self.auto_gc:
+            self.gc.collect()
+        return rc
+
+    '''Installs the tarball; the caller holds the lock for owner_name'''
+    def installPackageLocked(self,pkg_name,tarball_name,pkg_name_rel_num,tarball_path,owner_name):
+        if not os.path.isfile(tarball_path) or not os.access(tarball_path, os.R_OK):
+            loge ("Error: Cannot read package "+tarball_path)
+            return False
         rel_num,rel_ts=Pkg.parseTarballName(tarball_name)
 
         self.extra_vars['OPKG_NAME'] = pkg_name
@@ -717,15 +1176,522 @@ class Deploy():
         pkg.setEnvConfig(self.env_conf)
         pkg.loadMeta()
         if self.deploy_force or not pkg.isInstalled(tarball_path):
-            if not pkg.install(tarball_path,self,pkg_name):
+            if not self.checkFreeSpace(tarball_path):
+                return False
+            if not pkg.install(tarball_path,self,owner_name):
                 loge ("Error installing")
+                return False
         else:
             print ("Info: This revision of package "+pkg_name+" is already installed at "+self.install_root+'/installs/'+pkg.getMeta()['latest_install']['deploy_ts']+'/'+pkg_name)
             print ("Info: Use --force option to override.")
         return True
 
+'''Class to keep the disk space used by staging, undo packages and history
+   within the budgets set in the [gc] section of vpkg.env'''
+class GarbageCollector():
+    def __init__(self,env_conf):
+        self.opkg_dir=env_conf['basic']['opkg_dir']
+        self.stage_dir=env_conf['basic']['stage_dir']
+        self.history=History(env_conf)
+        self.undo_quota=parseSize(env_conf['gc']['undo_quota'])
+        self.history_quota=parseSize(env_conf['gc']['history_quota'])
+        self.min_free_space=parseSize(env_conf['gc']['min_free_space'])
+        self.reclaimed=0
+
+    '''Runs all of the collectors, returning the number of bytes freed'''
+    def collect(self):
+        self.reclaimed=0
+        self.collectStage()
+        self.collectUndo()
+        self.collectHistory()
+        return self.reclaimed
+
+    def remove(self,path,size=None):
+        if size is None: size=pathSize(path)
+        print ("Info: Removing "+path+" ("+str(size)+" bytes)")
+        if os.path.isdir(path) and not os.path.islink(path):
+            rmtree(path)
+        else:
+            try:
+                os.remove(path)
+            except OSError as err:
+                loge ("Warning: Couldn't remove "+path+". "+str(err))
+                return
+        self.reclaimed+=size
+
+    '''Everything in the staging area is transient: a package is extracted and
+    its undo package built in stage_dir/<name>, which is only in use while
+    the package's lock is held.  Anything else of that layout was left behind
+    by a failed run; other files are left alone, in case stage_dir is shared.'''
+    def collectStage(self):
+        if not os.path.isdir(self.stage_dir): return
+        for entry in os.listdir(self.stage_dir):
+            path=os.path.join(self.stage_dir,entry)
+            if not self.isStaged(entry): continue
+            lock=PkgLock(self.opkg_dir,entry,False)
+            if not lock.acquire():
+                print ("Info: Skipping "+path+", it is in use.")
+                continue
+            try:
+                self.remove(path)
+            finally:
+                lock.release()
+
+    '''Returns True if the entry in stage_dir is the staging area of a package,
+    PKG/DEPLOY_TS, and not something else that shares the folder'''
+    def isStaged(self,entry):
+        path=os.path.join(self.stage_dir,entry)
+        if not re.match('^[\w][\w.+-]*$',entry) or not os.path.isdir(path) or os.path.islink(path):
+            return False
+        return any([re.match('^\d+$',name) and os.path.isdir(os.path.join(path,name)) for name in os.listdir(path)])
+
+    '''Undo packages other than the one for the latest install of each package
+    are never used again.  These are evicted, least recently used first,
+    until the undo packages fit in undo_quota.  Packages being worked on by
+    another run count towards the quota, but are left alone.'''
+    def collectUndo(self):
+        meta_root=os.path.join(self.opkg_dir,'meta')
+        if not os.path.isdir(meta_root): return
+        total=0
+        stale=[]
+        locks=[]
+        try:
+            for name in os.listdir(meta_root):
+                meta_dir=os.path.join(meta_root,name)
+                if not os.path.isdir(meta_dir): continue
+                lock=PkgLock(self.opkg_dir,name,False)
+                locked=lock.acquire()
+                if locked: locks.append(lock)
+                latest=Pkg(name).loadMetaFile(os.path.join(meta_dir,META_FILE_LATEST))
+                for f in os.listdir(meta_dir):
+                    if not f.endswith('.vpkg'): continue
+                    path=os.path.join(meta_dir,f)
+                    size=pathSize(path)
+                    total+=size
+                    if not locked: continue
+                    if latest and f == latest['undo_package']: continue
+                    stale.append((lastUsed(path),path,size))
+
+            for last_used,path,size in sorted(stale):
+                if total <= self.undo_quota: break
+                self.remove(path,size)
+                total-=size
+        finally:
+            for lock in locks: lock.release()
+
+    '''Drops the oldest segments of the deploy history so it fits in history_quota'''
+    def collectHistory(self):
+        self.history.importLegacy()
+        self.reclaimed+=self.history.collect(self.history_quota)
+
+'''The deploy history: JSON lines, one per event, in segments of about
+history_segment_size bytes under OPKG_DIR/history.  An index of the time span
+and packages in each segment lets queries skip the segments they don't need.'''
+class History():
+    INDEX_FILE='index.json'
+    INDEX_VERSION=1
+
+    def __init__(self,env_conf):
+        self.opkg_dir=env_conf['basic']['opkg_dir']
+        self.history_dir=os.path.join(self.opkg_dir,'history')
+        self.index_path=os.path.join(self.history_dir,History.INDEX_FILE)
+        self.segment_size=parseSize(env_conf['gc']['history_segment_size'])
+        '''The plain-text log kept before the history was segmented'''
+        self.legacy_path=os.path.join(self.history_dir,env_conf['basic']['deploy_history_file'])
+        self.pending=[]
+
+    def log(self,record):
+        self.pending.append(record)
+
+    def loadIndex(self):
+        if os.path.isfile(self.index_path):
+            try:
+                index=json.loads(loadFile(self.index_path))
+                if index.get('version') == History.INDEX_VERSION: return index
+            except ValueError:
+                loge ("Warning: Ignoring damaged history index "+self.index_path)
+        return {'version':History.INDEX_VERSION, 'next':1, 'segments':[]}
+
+    def saveIndex(self,index):
+        with open(self.index_path+'.tmp','w') as f:
+            json.dump(index,f,sort_keys=True)
+        os.rename(self.index_path+'.tmp',self.index_path)
+
+    '''Appends the buffered entries to the newest segment, starting a new one
+       when it is full'''
+    def flush(self):
+        if not self.pending: return
+        makedirs(self.history_dir)
+        with PkgLock(self.opkg_dir,GLOBAL_LOCK):
+            index=self.loadIndex()
+            segments=index['segments']
+            if not segments or segments[-1]['size'] >= self.segment_size:
+                segments.append({'name':'%08d.jsonl' % index['next'], 'size':0, 'pkgs':[],
+                                 'first':self.pending[0]['time'], 'last':self.pending[0]['time']})
+                index['next']+=1
+            segment=segments[-1]
+            lines=''.join([json.dumps(record,sort_keys=True)+'\n' for record in self.pending])
+            with open(os.path.join(self.history_dir,segment['name']),'a') as hf:
+                hf.write(lines)
+            segment['size']+=len(lines)
+            segment['last']=self.pending[-1]['time']
+            for record in self.pending:
+                if record['pkg'] and record['pkg'] not in segment['pkgs']:
+                    segment['pkgs'].append(record['pkg'])
+            self.saveIndex(index)
+        self.pending=[]
+
+    '''Moves the entries of the old plain-text log, "DEPLOY_TS: message" lines,
+       into segments ahead of the rest of the history, and removes the log.
+       The entries have no package, action or release.'''
+    def importLegacy(self):
+        if not os.path.isfile(self.legacy_path): return
+        print ("Info: Moving "+self.legacy_path+" into the deploy history")
+        makedirs(self.history_dir)
+        with PkgLock(self.opkg_dir,GLOBAL_LOCK):
+            index=self.loadIndex()
+            imported=[]
+            segment=None
+            for line in loadFile(self.legacy_path).splitlines():
+                m=re.match('^(\d+): (.*)$',line)
+                if not m: continue
+                ts=int(m.group(1))
+                record={'ts':ts, 'time':float(ts), 'pkg':None, 'action':None, 'rel_num':None, 'msg':m.group(2)}
+                if not segment or segment['size'] >= self.segment_size:
+                    segment={'name':'%08d.jsonl' % index['next'], 'size':0, 'pkgs':[], 'first':ts, 'last':ts}
+                    index['next']+=1
+                    imported.append((segment,[]))
+                entry=json.dumps(record,sort_keys=True)+'\n'
+                imported[-1][1].append(entry)
+                segment['size']+=len(entry)
+                segment['last']=max(segment['last'],ts)
+            for segment,lines in imported:
+                with open(os.path.join(self.history_dir,segment['name']),'w') as hf:
+                    hf.write(''.join(lines))
+            index['segments']=[segment for segment,lines in imported]+index['segments']
+            self.saveIndex(index)
+            os.remove(self.legacy_path)
+
+    '''Returns the entries for the given packages (or all of them) since the
+       given time, oldest first.  Only the segments that might hold them are read.'''
+    def query(self,pkgs=None,since=None):
+        records=[]
+        for segment in self.loadIndex()['segments']:
+            if since is not None and segment['last'] < since: continue
+            if pkgs and not set(pkgs) & set(segment['pkgs']): continue
+            path=os.path.join(self.history_dir,segment['name'])
+            if not os.path.isfile(path): continue
+            with open(path) as hf:
+                for line in hf:
+                    try:
+                        record=json.loads(line)
+                    except ValueError:
+                        continue
+                    if since is not None and record['time'] < since: continue
+                    if pkgs and record['pkg'] not in pkgs: continue
+                    records.append(record)
+        return records
+
+    '''Removes the oldest segments until the history fits in quota, returning
+       the number of bytes freed'''
+    def collect(self,quota):
+        reclaimed=0
+        if not os.path.isfile(self.index_path): return reclaimed
+        with PkgLock(self.opkg_dir,GLOBAL_LOCK):
+            index=self.loadIndex()
+            segments=index['segments']
+            total=sum([segment['size'] for segment in segments])
+            while segments and total > quota:
+                segment=segments.pop(0)
+                path=os.path.join(self.history_dir,segment['name'])
+                print ("Info: Removing "+path+" ("+str(segment['size'])+" bytes)")
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total-=segment['size']
+                reclaimed+=segment['size']
+            self.saveIndex(index)
+        return reclaimed
+
+'''Pushes changes in a package's [files] sources straight to a target root, for
+a quick edit-install loop while developing.  An index of the sources' mtime,
+size and hash tells which files changed, and only those are copied; templates
+and replaces are re-applied to just the copied files they cover.  inotify says
+when to look, if the kernel has it, otherwise the sources are polled.
+There is no undo snapshot and the install isn't recorded.'''
+class Watcher():
+    def __init__(self,env_conf,pkg_name,root,vars_dict,poll=False):
+        self.opkg_dir=env_conf['basic']['opkg_dir']
+        self.poll_interval=float(env_conf['watch']['poll_interval'])
+        self.debounce=float(env_conf['watch']['debounce'])
+        self.max_delay=float(env_conf['watch']['max_delay'])
+        self.pkg=Pkg(pkg_name)
+        self.root=root
+        self.vars=vars_dict
+        self.vars['OPKG_NAME']=pkg_name
+        self.vars['OPKG_REL_NUM']='dev'
+        self.vars['OPKG_TS']=str(int(time.time()))
+        self.manifest=None
+        self.manifest_mtime=None
+        self.index=dict() #target path -> (source path, mtime, size, sha1)
+        self.dirs=dict() #folder to watch -> names of the files in it to watch, None for all
+        self.notify=None
+        if not poll: self.notify=Inotify.open()
+
+    '''Pushes the package once, then whatever changes until interrupted'''
+    def run(self):
+        if not self.reload():
+            return False
+        if self.notify:
+            print ("Info: Watching "+self.pkg.name+" with inotify, pushing to "+self.root)
+        else:
+            print ("Info: Polling "+self.pkg.name+" every "+str(self.poll_interval)+"s, pushing to "+self.root)
+        self.push(self.scan())
+        try:
+            while True:
+                self.wait()
+                changed=self.changes()
+                if changed: self.push(changed)
+        except KeyboardInterrupt:
+            print ("Info: Stopped watching "+self.pkg.name)
+        return True
+
+    '''Re-reads the manifest if it changed.  Everything is pushed again after
+    that, since any of the files, templates or replaces may be different.'''
+    def reload(self):
+        try:
+            mtime=os.stat(self.pkg.manifest_path).st_mtime
+        except OSError:
+            loge ("Error: Cannot find "+self.pkg.manifest_path)
+            return False
+        if mtime == self.manifest_mtime:
+            return True
+        self.manifest_mtime=mtime
+        manifest=Manifest.load(self.pkg.manifest_path,self.vars)
+        if not manifest:
+            return self.manifest is not None
+        if self.manifest: print ("Info: "+self.pkg.manifest_file+" changed, pushing all files")
+        for tgt,src in manifest.files:
+            if not InstallPlan.covers(tgt):
+                print ("Warning: "+tgt+" isn't in a folder that is installed, it won't be pushed")
+        self.manifest=manifest
+        self.index=dict()
+        return True
+
+    '''Returns the path on the target for a path in the manifest'''
+    def targetPath(self,path):
+        return os.path.join(self.root,path.strip('/'))
+
+    '''Adds the file to those watched, unless its folder is watched already'''
+    def watchFile(self,path):
+        folder,name=os.path.split(os.path.normpath(path))
+        if folder in self.dirs and self.dirs[folder] is None: return
+        self.dirs.setdefault(folder,set()).add(name)
+
+    '''Yields the (target, source) of each file the [files] sources hold'''
+    def sources(self):
+        self.dirs=dict()
+        self.watchFile(self.pkg.manifest_path)
+        for tgt,src in self.manifest.files:
+            if not InstallPlan.covers(tgt): continue
+            src_path=os.path.join(self.pkg.build_root,src)
+            tgt_path=self.targetPath(tgt)
+            if not os.path.isdir(src_path):
+                self.watchFile(src_path)
+                yield tgt_path,src_path
+                continue
+            for root, dirs, files in os.walk(src_path):
+                self.dirs[os.path.normpath(root)]=None
+                rel=os.path.relpath(root,src_path)
+                for f in files:
+                    yield os.path.normpath(os.path.join(tgt_path,rel,f)),os.path.join(root,f)
+
+    '''Returns the targets whose sources changed since the last scan.  Only
+    files whose mtime or size changed are hashed.'''
+    def scan(self):
+        changed=[]
+        seen=set()
+        for target,source in self.sources():
+            try:
+                st=os.stat(source)
+                entry=self.index.get(target)
+                if entry and entry[:3] == (source,st.st_mtime,st.st_size):
+                    seen.add(target)
+                    continue
+                digest=getFileSHA1(source)
+            except (IOError, OSError):
+                continue #removed while scanning; the next scan sees that
+            seen.add(target)
+            self.index[target]=(source,st.st_mtime,st.st_size,digest)
+            if not entry or entry[3] != digest: changed.append(target)
+        for target in set(self.index)-seen:
+            print ("Warning: Source of "+target+" was removed, it is left on the target")
+            del self.index[target]
+        return changed
+
+    '''Blocks until the sources may have changed'''
+    def wait(self):
+        if not self.notify:
+            time.sleep(self.poll_interval)
+            return
+        self.notify.watch(self.dirs)
+        self.notify.wait(None)
+
+    '''Returns the targets that changed, once a burst of changes, such as an
+    editor saving or a build writing many files, has settled, or after
+    max_delay seconds if it doesn't.'''
+    def changes(self):
+        changed=set()
+        started=time.time()
+        while True:
+            if not self.reload(): return []
+            more=self.scan()
+            changed.update(more)
+            if self.notify:
+                self.notify.watch(self.dirs)
+                if not self.notify.wait(self.debounce): break
+            else:
+                if not more: break
+                time.sleep(self.debounce)
+            if time.time()-started >= self.max_delay: break
+        return sorted(changed)
+
+    '''Copies the changed files to the target, and re-applies the templates and
+    replaces that cover them.  The package's lock is held, so this doesn't
+    interleave with an install of the package.'''
+    def push(self,changed):
+        with PkgLock(self.opkg_dir,self.pkg.name):
+            for target in changed:
+                source=self.index[target][0]
+                try:
+                    makedirs(os.path.dirname(target))
+                    shutil.copy2(source,target)
+                except (IOError, OSError) as err:
+                    loge ("Error: Cannot push "+source+" to "+target+": "+str(err))
+                    continue
+                if not self.render(target): continue
+                print ("Info: Pushed "+target)
+        return True
+
+    '''Re-applies the templates and replaces covering target.  Like install,
+    only absolute paths are applied to the installed files; relative ones only
+    change the package's staged copy.'''
+    def render(self,target):
+        for tmpl in self.manifest.templates:
+            if not os.path.isabs(tmpl): continue
+            if not isUnder(target,self.targetPath(tmpl)): continue
+            if not Tmpl(target).resolveVars(self.vars):
+                return False
+        for replaces_file,pattern,replace in self.manifest.replaces:
+            if not os.path.isabs(replaces_file): continue
+            if not isUnder(target,self.targetPath(replaces_file)): continue
+            if not Tmpl(target).replaceTokens(pattern,replace):
+                return False
+        return True
+
+'''Minimal inotify binding through libc.  The events are only used to wake up
+the watcher; its index works out what changed.'''
+class Inotify():
+    '''IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE'''
+    MASK=0x002|0x004|0x008|0x040|0x080|0x100|0x200
+    '''Events that may mean anything changed: IN_Q_OVERFLOW | IN_IGNORED'''
+    ANY_CHANGE=0x4000|0x8000
+    '''struct inotify_event, without the name that follows it'''
+    EVENT=struct.Struct('iIII')
+
+    def __init__(self,libc,fd):
+        self.libc=libc
+        self.fd=fd
+        self.filters=dict() #watch descriptor -> names to wake for, None for all
+
+    '''Returns None if inotify isn't available'''
+    @staticmethod
+    def open():
+        try:
+            libc=ctypes.CDLL(ctypes.util.find_library('c'),use_errno=True)
+            fd=libc.inotify_init()
+        except (OSError, AttributeError):
+            return None
+        if fd < 0:
+            return None
+        return Inotify(libc,fd)
+
+    '''Watches the folders, dirs maps each to the names of the files in it to
+    wake for, or None for any.  Watching a folder again is harmless, and picks
+    up folders that were removed and created again.'''
+    def watch(self,dirs):
+        self.filters=dict()
+        for path in dirs:
+            wd=self.libc.inotify_add_watch(self.fd,path,Inotify.MASK)
+            if wd >= 0: self.filters[wd]=dirs[path]
+
+    '''Returns False if nothing watched happened within timeout seconds'''
+    def wait(self,timeout):
+        deadline=None
+        if timeout is not None: deadline=time.time()+timeout
+        while True:
+            left=None
+            if deadline is not None: left=max(0,deadline-time.time())
+            ready,_,_=select.select([self.fd],[],[],left)
+            if not ready:
+                return False
+            if self.isWatched(os.read(self.fd,65536)):
+                return True
+
+    '''Returns True if any of the events read are for a file being watched'''
+    def isWatched(self,events):
+        offset=0
+        while offset+Inotify.EVENT.size <= len(events):
+            wd,mask,cookie,length=Inotify.EVENT.unpack_from(events,offset)
+            offset+=Inotify.EVENT.size
+            name=events[offset:offset+length].rstrip(b'\0')
+            offset+=length
+            if mask & Inotify.ANY_CHANGE: return True
+            if wd not in self.filters: continue
+            if self.filters[wd] is None or name in self.filters[wd]: return True
+        return False
+
 '''Utility classes '''
 
+'''Advisory lock on a package's metadata and staging area, so independent
+vector-pkg.py runs, or threads, can work on different packages at once.
+The lock files are kept under OPKG_DIR/lock.  flock() is used since each
+open of the lock file is locked separately, even within one process.'''
+class PkgLock():
+    def __init__(self,opkg_dir,name,blocking=True):
+        self.path=os.path.join(opkg_dir,'lock',name+'.lock')
+        self.blocking=blocking
+        self.lock_file=None
+
+    '''Returns False if the lock is non-blocking and held by someone else'''
+    def acquire(self):
+        makedirs(os.path.dirname(self.path))
+        lock_file=open(self.path,'a')
+        flags=fcntl.LOCK_EX
+        if not self.blocking: flags|=fcntl.LOCK_NB
+        try:
+            fcntl.flock(lock_file,flags)
+        except (IOError, OSError) as err:
+            lock_file.close()
+            if err.errno in [errno.EAGAIN, errno.EACCES]: return False
+            raise
+        self.lock_file=lock_file
+        return True
+
+    def release(self):
+        if not self.lock_file: return
+        fcntl.flock(self.lock_file,fcntl.LOCK_UN)
+        self.lock_file.close()
+        self.lock_file=None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.release()
+
 '''Utility class to do template related tasks'''
 class Tmpl():
     TMPL_KEY_VAL_DELIM=':'
@@ -756,30 +1722,26 @@ class Tmpl():
 
         return True
 
-    '''Recreates files under tmpl_path with values from vars_list
-    vars_list contains a search/replace pair SEARCH-STR:REPLACE-STR, the file is updated by replacing all SEARCH-STR with REPLACE-STR
+    '''Recreates files under tmpl_path, replacing all of pattern with replace
     tmpl_path could be single file or a directory, 
     in the latter case all files in the dir will be checked for recursively.
     '''
-    def replaceTokens (self,tokens_list,backup=False):
+    def replaceTokens (self,pattern,replace,backup=False):
         if self.is_dir:
             files = os.listdir(self.tmpl_path)
             for f in files:
                 fpath = os.path.join(self.tmpl_path, f)
                 ftmpl = Tmpl(fpath)
-                ftmpl.replaceTokens(tokens_list,backup)
+                ftmpl.replaceTokens(pattern,replace,backup)
         else:
-            if not self.replaceTokensFile(self.tmpl_path,tokens_list, backup):
+            if not self.replaceTokensFile(self.tmpl_path,pattern,replace,backup):
                 loge ("Error: Failed to resolve template " + self.tmpl_path)
                 return False
 
         return True
 
     def resolveVarsFile(self,file_path, vars_dict, backup=False):
-        str = loadFile(file_path)
-        for var in vars_dict:
-            if var not in vars_dict or not vars_dict[var]: continue
-            str = re.sub('{{ ' + var + ' }}', vars_dict[var], str)
+        str = resolveVarsText(loadFile(file_path), vars_dict)
         if backup:
             if not execOSCommand("mv " + file_path + " " + file_path + '.' + str(int(time.time()))):
                 loge ("Error: Couldn't backup " + file_path)
@@ -793,9 +1755,8 @@ class Tmpl():
 
         return True
 
-    def replaceTokensFile(self,file_path, token, backup=False):
+    def replaceTokensFile(self,file_path, pattern, replace, backup=False):
         str = loadFile(file_path)
-        pattern, replace = re.split(Tmpl.TMPL_KEY_VAL_DELIM,token)
         str = re.sub(pattern, replace, str)
         if backup:
             if not execOSCommand("mv " + file_path + " " + file_path + '.' + str(int(time.time()))):
@@ -810,6 +1771,207 @@ class Tmpl():
 
         return True
 
+'''Tracks what a package was last built from, so that create can skip
+rebuilding it when neither the manifest nor any of its [files] sources
+have changed.  The cache is kept in BUILD_ROOT/.pkg/cache.'''
+class BuildCache():
+    CACHE_VERSION=2
+
+    def __init__(self,pkg):
+        self.pkg=pkg
+        self.cache_dir=os.path.join(pkg.build_root,'.pkg','cache')
+        self.record_path=os.path.join(self.cache_dir,pkg.name+'.json')
+        self.record=dict()
+        if os.path.isfile(self.record_path):
+            try:
+                self.record=json.loads(loadFile(self.record_path))
+            except ValueError:
+                print ("Warning: Ignoring damaged build cache "+self.record_path)
+        self.files=dict() #source path -> [size, mtime, mode, sha1], for the new record
+        self.fingerprint=self.computeFingerprint()
+
+    '''Hashes the manifest and every source file.  The source's hash is taken
+    from the previous record if its size, mtime and mode haven't changed.'''
+    def computeFingerprint(self):
+        h=hashlib.sha1()
+        h.update(('v'+str(BuildCache.CACHE_VERSION)+'\n').encode('utf-8'))
+        if self.pkg.seekable: h.update(b'seekable\n')
+        with open(self.pkg.manifest_path,'rb') as f:
+            h.update(f.read())
+        for tgt,src in sorted(self.pkg.manifest.files):
+            self.addSource(h,tgt.strip('/'),os.path.join(self.pkg.build_root,src))
+        return h.hexdigest()
+
+    def addSource(self,h,tgt,src):
+        if not os.path.exists(src):
+            # stageContent skips missing files
+            h.update(('missing '+tgt+'\n').encode('utf-8'))
+            return
+        if not os.path.isdir(src):
+            h.update((tgt+' '+self.hashFile(src)+'\n').encode('utf-8'))
+            return
+        for root, dirs, files in os.walk(src, followlinks=True):
+            dirs.sort()
+            rel_root=os.path.relpath(root,src)
+            h.update(('dir '+os.path.normpath(os.path.join(tgt,rel_root))+'\n').encode('utf-8'))
+            for f in sorted(files):
+                self.addSource(h,os.path.normpath(os.path.join(tgt,rel_root,f)),os.path.join(root,f))
+
+    def hashFile(self,path):
+        st=os.stat(path)
+        old=self.record.get('files',dict()).get(path)
+        if old and old[:3] == [st.st_size,st.st_mtime,st.st_mode]:
+            digest=old[3]
+        else:
+            digest=getFileSHA1(path)
+        self.files[path]=[st.st_size,st.st_mtime,st.st_mode,digest]
+        return str(st.st_mode)+' '+digest
+
+    '''Puts the cached package at tarball_path, if it was built from the same inputs'''
+    def fetch(self,tarball_path):
+        if self.record.get('fingerprint') != self.fingerprint: return False
+        cached_path=os.path.join(self.cache_dir,self.record.get('tarball',''))
+        if not os.path.isfile(cached_path): return False
+        if self.record.get('files') != self.files:
+            # the sources were touched but not changed; keep their new stats,
+            # so they aren't hashed again next time
+            self.record['files']=self.files
+            self.saveRecord()
+        if os.path.isfile(tarball_path) and getFileMD5(tarball_path) == self.record.get('md5'):
+            return True
+        shutil.copy(cached_path,tarball_path)
+        return True
+
+    '''Saves a copy of the newly built package, along with what it was built from'''
+    def store(self,tarball_path):
+        makedirs(self.cache_dir)
+        tarball_name=os.path.basename(tarball_path)
+        old_tarball=self.record.get('tarball')
+        if old_tarball and old_tarball != tarball_name:
+            try:
+                os.remove(os.path.join(self.cache_dir,old_tarball))
+            except OSError:
+                pass
+        shutil.copy(tarball_path,os.path.join(self.cache_dir,tarball_name))
+        self.record={'version':BuildCache.CACHE_VERSION, 'fingerprint':self.fingerprint,
+                     'tarball':tarball_name, 'md5':getFileMD5(tarball_path), 'files':self.files}
+        self.saveRecord()
+
+    def saveRecord(self):
+        with open(self.record_path+'.tmp','w') as f:
+            json.dump(self.record,f)
+        os.rename(self.record_path+'.tmp',self.record_path)
+
+'''Reads a package.  A seekable package is a series of gzip members, each
+holding whole files of the tarball, so any member can be decompressed on its
+own -- and the whole is still a .tgz to gzip and tar.  The last file in the
+tarball is a table of contents giving the blocks' offsets and the files in
+each.  It is found through the package's final, empty, gzip member, whose
+header carries the table of contents' offset and length.'''
+class VpkgArchive():
+    '''gzip header with the FEXTRA flag, no mtime or name; then the extra field'''
+    TRAILER_HEADER=b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff'
+    TRAILER_ID=b'VP'
+    '''an empty deflate stream, and the crc and size of nothing'''
+    TRAILER_END=b'\x03\x00'+b'\x00'*8
+    TRAILER_SIZE=len(TRAILER_HEADER)+2+4+16+len(TRAILER_END)
+    TOC_VERSION=1
+
+    def __init__(self,tarball_path):
+        self.tarball_path=tarball_path
+        self.toc=self.readToc()
+
+    @staticmethod
+    def makeTrailer(toc_offset,toc_length):
+        extra=VpkgArchive.TRAILER_ID+struct.pack('<H',16)+struct.pack('<QQ',toc_offset,toc_length)
+        return VpkgArchive.TRAILER_HEADER+struct.pack('<H',len(extra))+extra+VpkgArchive.TRAILER_END
+
+    '''Returns the table of contents, or None if the package isn't seekable'''
+    def readToc(self):
+        with open(self.tarball_path,'rb') as f:
+            f.seek(0,os.SEEK_END)
+            if f.tell() < VpkgArchive.TRAILER_SIZE: return None
+            f.seek(-VpkgArchive.TRAILER_SIZE,os.SEEK_END)
+            trailer=f.read(VpkgArchive.TRAILER_SIZE)
+        header_size=len(VpkgArchive.TRAILER_HEADER)
+        if not trailer.startswith(VpkgArchive.TRAILER_HEADER): return None
+        if trailer[header_size+2:header_size+4] != VpkgArchive.TRAILER_ID: return None
+        toc_offset,toc_length=struct.unpack('<QQ',trailer[header_size+6:header_size+22])
+        tf=tarfile.open(fileobj=BytesIO(self.readBlock([toc_offset,toc_length])),mode='r:')
+        toc=json.loads(tf.extractfile(SEEKABLE_TOC_MEMBER).read().decode('utf-8'))
+        if toc.get('version') != VpkgArchive.TOC_VERSION: return None
+        return toc
+
+    '''Returns the decompressed content of a block, given its [offset, length]'''
+    def readBlock(self,block):
+        with open(self.tarball_path,'rb') as f:
+            f.seek(block[0])
+            data=f.read(block[1])
+        return zlib.decompressobj(16+zlib.MAX_WBITS).decompress(data)
+
+    '''Returns the (name, size, is_dir) of each file in the package'''
+    def members(self):
+        if self.toc:
+            return [(m[0],m[3],m[4]) for m in self.toc['members']]
+        tf=tarfile.open(self.tarball_path,'r:*')
+        try:
+            return [(m.name,m.size,m.isdir()) for m in tf.getmembers()]
+        finally:
+            tf.close()
+
+    '''Returns the content of a file in the package, or None if it isn't there'''
+    def readMember(self,name):
+        if self.toc:
+            for m in self.toc['members']:
+                if m[0] != name: continue
+                data=self.readBlock(self.toc['blocks'][m[1]])
+                tf=tarfile.open(fileobj=BytesIO(data[m[2]:]),mode='r:')
+                return tf.extractfile(tf.next()).read()
+            return None
+        tf=tarfile.open(self.tarball_path,'r:*')
+        try:
+            for m in tf:
+                if m.name == name: return tf.extractfile(m).read()
+        finally:
+            tf.close()
+        return None
+
+    '''Extracts the files that is_selected(name) accepts into dest_dir.  The
+    blocks of a seekable package are decompressed by up to workers threads,
+    a few at a time to bound how much is held in memory.'''
+    def extract(self,dest_dir,is_selected,workers=1):
+        if not self.toc:
+            tf=tarfile.open(self.tarball_path,'r:*')
+            try:
+                members=[m for m in tf.getmembers() if is_selected(m.name)]
+                for m in members: VpkgArchive.checkMember(m.name,dest_dir)
+                for m in members: tf.extract(m,dest_dir)
+            finally:
+                tf.close()
+            return
+
+        for m in self.toc['members']: VpkgArchive.checkMember(m[0],dest_dir)
+        wanted=sorted(set([m[1] for m in self.toc['members'] if is_selected(m[0])]))
+        workers=max(1,workers)
+        for i in range(0,len(wanted),workers):
+            batch=[self.toc['blocks'][idx] for idx in wanted[i:i+workers]]
+            for data in runParallel(self.readBlock,batch,workers):
+                tf=tarfile.open(fileobj=BytesIO(data),mode='r:')
+                members=[m for m in tf.getmembers() if is_selected(m.name)]
+                for m in members: VpkgArchive.checkMember(m.name,dest_dir)
+                for m in members: tf.extract(m,dest_dir)
+
+    '''Raises an error, as tar would, for a member that would be extracted
+    outside of dest_dir: an absolute path, or one going up with ..'''
+    @staticmethod
+    def checkMember(name,dest_dir):
+        path=os.path.normpath(name)
+        dest=os.path.realpath(dest_dir)
+        target=os.path.realpath(os.path.join(dest,path))
+        if os.path.isabs(name) or path == '..' or path.startswith('..'+os.sep) or \
+           not (target == dest or target.startswith(dest+os.sep)):
+            raise tarfile.ExtractError("Refusing to extract "+name+", it is outside of the package")
+
 ''' Utility Functions '''
 
 '''returns the status code after executing cmd in the shell'''
@@ -826,6 +1988,13 @@ def execOSCommand(cmd):
    return True
 
 
+'''returns text with the template vars, marked as {{ var }}, replaced by their values'''
+def resolveVarsText(text,vars_dict):
+    for var in vars_dict:
+        if not vars_dict[var]: continue
+        text = re.sub('{{ ' + var + ' }}', vars_dict[var], text)
+    return text
+
 '''returns the file content as a string.'''
 def loadFile(file_path):
     s = open(file_path)
@@ -835,12 +2004,221 @@ def loadFile(file_path):
     return str
 
 
+'''returns True if path is folder, or is in it'''
+def isUnder(path,folder):
+    folder=folder.rstrip('/')
+    return path == folder or path.startswith(folder+'/')
+
+'''returns True for the yes/no style flags in config files'''
+def isTrue(val):
+    return str(val).strip().lower() in ['1','yes','true','on']
+
+'''converts a size such as 512K or 16M into bytes'''
+def parseSize(size):
+    m = re.match('^(\d+)([KMG]?)B?$', str(size).strip().upper())
+    if not m:
+        loge ("Warning: Cannot parse size "+str(size))
+        return 0
+    return int(m.group(1))*SIZE_UNITS[m.group(2)]
+
+'''returns the number of bytes used by a file or directory tree'''
+def pathSize(path):
+    if os.path.islink(path): return 0
+    if not os.path.isdir(path):
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
+    total=0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            total+=pathSize(os.path.join(root,f))
+    return total
+
+'''converts a time given as seconds since the epoch, a date (2020-12-05 or
+2020-12-05T13:00:00), or an age (30m, 12h, 7d) into seconds since the epoch'''
+def parseTime(when):
+    when=when.strip()
+    if re.match('^\d+(\.\d+)?$', when): return float(when)
+    m = re.match('^(\d+)([smhd])$', when)
+    if m:
+        return time.time()-int(m.group(1))*{'s':1,'m':60,'h':3600,'d':86400}[m.group(2)]
+    for fmt in ['%Y-%m-%dT%H:%M:%S','%Y-%m-%d %H:%M:%S','%Y-%m-%d']:
+        try:
+            return time.mktime(time.strptime(when,fmt))
+        except ValueError:
+            pass
+    return None
+
+'''returns when a file was last used, for least-recently-used eviction'''
+def lastUsed(path):
+    try:
+        st=os.stat(path)
+    except OSError:
+        return 0
+    return max(st.st_atime,st.st_mtime)
+
+'''returns the bytes available on the filesystem that holds path'''
+def freeSpace(path):
+    while not os.path.exists(path):
+        path=os.path.dirname(path)
+    st=os.statvfs(path)
+    return st.f_bavail*st.f_frsize
+
+'''returns the size of a gzip file's content, from its trailer.  This is
+modulo 4G, and only of the last member if there are several.'''
+def getGzipSize(file_path):
+    try:
+        with open(file_path,'rb') as f:
+            f.seek(-4,os.SEEK_END)
+            return struct.unpack('<I',f.read(4))[0]
+    except (IOError, OSError, struct.error):
+        return 0
+
+'''returns the device of the filesystem that holds path'''
+def deviceOf(path):
+    while not os.path.exists(path):
+        path=os.path.dirname(path)
+    return os.stat(path).st_dev
+
+'''Calls func on each item using up to workers threads, returning the results in order'''
+def runParallel(func,items,workers):
+    items=list(items)
+    if workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    results=[None]*len(items)
+    errors=[]
+    todo=iter(enumerate(items))
+    lock=threading.Lock()
+    def worker():
+        while not errors:
+            with lock:
+                try:
+                    i,item=next(todo)
+                except StopIteration:
+                    return
+            try:
+                results[i]=func(item)
+            except Exception as err:
+                errors.append(err)
+    threads=[threading.Thread(target=worker) for n in range(min(workers,len(items)))]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    if errors: raise errors[0]
+    return results
+
 def Exit(rc):
     sys.exit(rc)
 
 def getFileMD5(file_path):
     return hashlib.md5(open(file_path, 'rb').read()).hexdigest()
 
+def getFileSHA1(file_path):
+    h=hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(65536), b''):
+            h.update(block)
+    return h.hexdigest()
+
+'''Writes the sha1sum-style hash of each file under root_dir, except those in
+.install, giving their paths as installed'''
+def writeFileSums(sums_path,root_dir):
+    lines=[]
+    for root, dirs, files in os.walk(root_dir):
+        if root == root_dir and '.install' in dirs: dirs.remove('.install')
+        for f in files:
+            path=os.path.join(root,f)
+            if os.path.islink(path): continue
+            lines.append(getFileSHA1(path)+'  /'+os.path.relpath(path,root_dir)+'\n')
+    with open(sums_path,'w') as sf:
+        sf.write(''.join(sorted(lines,key=lambda line: line[42:])))
+
+'''Reads a file written by writeFileSums, returning a dict of path to hash, or
+None if there is no such file'''
+def readFileSums(sums_path):
+    if not os.path.isfile(sums_path): return None
+    sums=dict()
+    for line in loadFile(sums_path).splitlines():
+        if len(line) > 42: sums[line[42:]]=line[:40]
+    return sums
+
+'''Writes a gzip'd tarball of the entries in root_dir.  Entries are sorted, and
+their times and owners normalized, so the same content gives the same bytes.'''
+def makeTarball(tarball_path,root_dir,entries,seekable=False):
+    if seekable:
+        makeSeekableTarball(tarball_path,root_dir,entries)
+        return
+    with open(tarball_path,'wb') as f:
+        gz=gzip.GzipFile('','wb',6,f,0)
+        tf=tarfile.open(fileobj=gz,mode='w',format=tarfile.GNU_FORMAT)
+        try:
+            for info,path in tarEntries(tf,root_dir,sorted(entries)):
+                if info.isreg():
+                    with open(path,'rb') as src:
+                        tf.addfile(info,src)
+                else:
+                    tf.addfile(info)
+        finally:
+            tf.close()
+            gz.close()
+
+'''Writes a seekable tarball, see VpkgArchive.  A new block is started for each
+top-level folder, so the manifest in .install is in a block of its own.'''
+def makeSeekableTarball(tarball_path,root_dir,entries):
+    tf=tarfile.TarFile(fileobj=BytesIO(),mode='w',format=tarfile.GNU_FORMAT)
+    blocks=[]
+    members=[]
+    with open(tarball_path,'wb') as f:
+        block=BytesIO()
+        top=None
+        for info,path in tarEntries(tf,root_dir,sorted(entries)):
+            entry_top=info.name.split('/')[0]
+            if block.tell() and (entry_top != top or block.tell() >= SEEKABLE_BLOCK_SIZE):
+                blocks.append(writeGzipMember(f,block.getvalue()))
+                block=BytesIO()
+            top=entry_top
+            members.append([info.name,len(blocks),block.tell(),info.size,info.isdir()])
+            block.write(info.tobuf(tarfile.GNU_FORMAT))
+            if info.isreg():
+                with open(path,'rb') as src:
+                    shutil.copyfileobj(src,block)
+                block.write(b'\0'*(-info.size % tarfile.BLOCKSIZE))
+        if block.tell():
+            blocks.append(writeGzipMember(f,block.getvalue()))
+
+        '''The table of contents is the last file, followed by the end of the tarball'''
+        toc=json.dumps({'version':VpkgArchive.TOC_VERSION,'blocks':blocks,'members':members},
+                       sort_keys=True).encode('utf-8')
+        info=tarfile.TarInfo(SEEKABLE_TOC_MEMBER)
+        info.size=len(toc)
+        info.uname=info.gname='root'
+        block=info.tobuf(tarfile.GNU_FORMAT)+toc+b'\0'*(-info.size % tarfile.BLOCKSIZE)
+        toc_block=writeGzipMember(f,block+b'\0'*(2*tarfile.BLOCKSIZE))
+        f.write(VpkgArchive.makeTrailer(toc_block[0],toc_block[1]))
+
+'''Compresses data as a gzip member at the end of f, returning its [offset, length]'''
+def writeGzipMember(f,data):
+    offset=f.tell()
+    gz=gzip.GzipFile('','wb',6,f,0)
+    gz.write(data)
+    gz.close()
+    return [offset,f.tell()-offset]
+
+'''Yields the (TarInfo, path) for each entry in root_dir, and the files under
+them, in sorted order, with the times and owners normalized'''
+def tarEntries(tf,root_dir,entries):
+    for arcname in entries:
+        path=os.path.join(root_dir,arcname)
+        info=tf.gettarinfo(path,arcname)
+        info.mtime=0
+        info.uid=info.gid=0
+        info.uname=info.gname='root'
+        yield info,path
+        if info.isdir():
+            children=[os.path.join(arcname,name) for name in sorted(os.listdir(path))]
+            for child in tarEntries(tf,root_dir,children):
+                yield child
+
 ''' main '''
 
 opkg_cmd=opkg(sys.argv)